@@ -2,15 +2,33 @@
 # -*- coding: utf-8 -*-
 import os
 import io
+import functools
 import math
 import random
-import string
-from typing import Tuple, Optional, List
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterable, Tuple, Optional
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import cv2
 
+try:  # optional: fused frame composition for the byte-per-pixel encoders (cv2, NVENC)
+    import numba
+except ImportError:
+    numba = None
+try:  # optional: H.264 on the GPU's NVENC block (Video Processing Framework)
+    import PyNvCodec as nvc
+except ImportError:
+    nvc = None
+
+# Library callers may generate from several threads; numba's workqueue threading layer
+# must not run parallel kernels from two threads at once
+_NUMBA_LOCK = threading.Lock()
+
 """
 Time-encoded video CAPTCHA generator (Algorithm 2 inspired)
 - If you have a depth map D: pixels within [tl, tu] move with noise (y + v*t), others stay static
@@ -35,12 +53,28 @@ DEFAULT_DURATION_SEC = 4.0  # ~96 frames
 DEFAULT_SPEED_PX_PER_FRAME = 1  # vertical offset per frame
 DEFAULT_NOISE_BLOCK = 2  # speckle size
 DEFAULT_NOISE_DENSITY = 0.5  # probability of white block
+VIDEO_POOL_SIZE = 16  # reuse_video: distinct noise renders kept per (mode, answer)
+VIDEO_CACHE_SIZE = 256  # reuse_video: encoded MP4s kept per process (LRU)
+NVENC_GPU_ID = 0  # GPU used when PyNvCodec is installed
+FFMPEG_TIMEOUT_SEC = 30  # kill a stuck ffmpeg instead of hanging the worker
 FONT_PATHS_CANDIDATES = [
     "/System/Library/Fonts/Supplemental/Arial.ttf",       # macOS
     "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",    # Linux
     "C:\\Windows\\Fonts\\arial.ttf",                      # Windows
 ]
 
+_VIDEO_CACHE: "OrderedDict[tuple, bytes]" = OrderedDict()
+_VIDEO_CACHE_LOCK = threading.Lock()
+# One NVENC session (and CUDA context) per process and frame geometry, reused across
+# clips; NVENC sessions are not thread-safe, so encodes are serialized
+_NVENC_ENCODERS: dict = {}
+_NVENC_LOCK = threading.Lock()
+# Set after the first NVENC failure under backend='auto' (no GPU, driver mismatch, ...):
+# later clips go straight to the packed ffmpeg path instead of failing the same way again
+_NVENC_DISABLED = False
+
+BACKENDS = ("auto", "nvenc", "cpu")
+
 def _pick_font(size: int) -> ImageFont.FreeTypeFont:
     # Try to use better fonts for larger sizes
     if size >= 60:
@@ -73,26 +107,24 @@ def _make_tiled_noise(h: int, w: int, block: int, density: float, seed: Optional
 
     gh = math.ceil(h / block)
     gw = math.ceil(w / block)
-    grid = (rng.rand(gh, gw) < density).astype(np.uint8) * 255
-    # Expand to pixels
-    noise = np.kron(grid, np.ones((block, block), dtype=np.uint8))
-    noise = noise[:h, :w]
+    cells = gh * gw
+    if abs(density - 0.5) < 1e-6:
+        # Fair coin per cell: one random byte covers 8 cells, unpacked straight to {0, 1}
+        bits = np.unpackbits(np.frombuffer(rng.bytes((cells + 7) // 8), dtype=np.uint8), count=cells)
+        grid = bits.reshape(gh, gw) * np.uint8(255)
+    else:
+        # One random byte per cell instead of a float64 draw; density quantized to 1/256
+        grid = (rng.randint(0, 256, size=(gh, gw), dtype=np.uint8) < int(density * 256)).astype(np.uint8) * 255
+    # Expand to pixels: broadcast each cell over a block x block tile (no kron temp/multiply)
+    noise = np.broadcast_to(grid[:, None, :, None], (gh, block, gw, block)).reshape(gh * block, gw * block)
+    # Copies only when the slice is strided or still a read-only view (block == 1)
+    noise = np.require(noise[:h, :w], requirements=["C", "W"])
 
     # Make tileable by copying edges
     noise[0, :] = noise[-1, :]
     noise[:, 0] = noise[:, -1]
     return noise
 
-def _shift_vertical(src: np.ndarray, offset: int) -> np.ndarray:
-    """
-    Shift vertically with wrap (tileable). Positive offset moves content downward.
-    """
-    h = src.shape[0]
-    off = offset % h
-    if off == 0:
-        return src
-    return np.roll(src, shift=off, axis=0)
-
 def _render_text_mask(w: int, h: int, text: str, font_size_ratio: float = 0.35) -> np.ndarray:
     """
     Render a binary mask for text centered in the frame.
@@ -149,6 +181,17 @@ def _render_shape_mask(w: int, h: int, shape: str) -> np.ndarray:
     mask = np.array(img, dtype=np.uint8)
     return (mask > 127).astype(np.uint8)
 
+@functools.lru_cache(maxsize=16)
+def _shape_mask_cached(shape: str, w: int, h: int) -> np.ndarray:
+    """
+    Memoized shape mask: only five shapes exist, so every call after the first is a hit.
+    (Text answers are effectively unique and are rendered per call.)
+    The returned array is shared between calls and therefore read-only.
+    """
+    mask = _render_shape_mask(w, h, shape)
+    mask.setflags(write=False)
+    return mask
+
 def _depth_mask_from_image(depth_img: np.ndarray, tl: int, tu: int) -> np.ndarray:
     """
     Create moving mask from grayscale depth image using thresholds [tl, tu].
@@ -159,97 +202,363 @@ def _depth_mask_from_image(depth_img: np.ndarray, tl: int, tu: int) -> np.ndarra
     mask = ((d >= tl) & (d <= tu)).astype(np.uint8)
     return mask
 
-def generate_time_captcha(
-    mode: str = "text",                # 'text' | 'shape' | 'depth'
-    answer: Optional[str] = None,      # ground truth word/shape; required for text/shape
-    depth_image: Optional[np.ndarray] = None,  # uint8 grayscale for 'depth' mode
-    thresholds: Tuple[int, int] = (90, 180),
-    size: Tuple[int, int] = (DEFAULT_WIDTH, DEFAULT_HEIGHT),
-    fps: int = DEFAULT_FPS,
-    duration_sec: float = DEFAULT_DURATION_SEC,
-    speed_px_per_frame: int = DEFAULT_SPEED_PX_PER_FRAME,
-    noise_block: int = DEFAULT_NOISE_BLOCK,
-    noise_density: float = DEFAULT_NOISE_DENSITY,
-    seed: Optional[int] = None,
-) -> Tuple[bytes, str]:
+def _frame_offsets(
+    frames_n: int,
+    h: int,
+    speed_px_per_frame: int,
+    rng: np.random.RandomState,
+) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Generate MP4 bytes and ground-truth string.
+    Per-frame vertical start row and horizontal jitter, shared by every composition path.
     """
-    w, h = size
-    frames_n = int(fps * duration_sec)
-    rng = np.random.RandomState(seed)
+    # Foreground moves downward, so frame t starts at row (-v*t) % h of the noise
+    offs = (-speed_px_per_frame * np.arange(frames_n)) % h
+    # Optional slight horizontal jitter to make replay harder: every 7th frame, one vector draw
+    jitter = np.zeros(frames_n, dtype=np.int64)
+    jitter[::7] = rng.randint(-1, 2, size=(frames_n + 6) // 7)
+    return offs, jitter
 
-    # Prepare mask M(x,y) ∈ {0,1}
+def _build_frames_packed(
+    noise: np.ndarray,
+    mask: np.ndarray,
+    frames_n: int,
+    speed_px_per_frame: int,
+    rng: np.random.RandomState,
+) -> np.ndarray:
+    """
+    Build the clip at 1 bit per pixel in np.packbits layout [frames_n, h, ceil(w/8)]
+    (MSB first, 1 = white), which ffmpeg reads directly as monob.
+    Mask pixels take the shifted noise, the rest stay static.
+    """
+    h, w = noise.shape
+    offs, jitter = _frame_offsets(frames_n, h, speed_px_per_frame, rng)
+    # 2H x 2W tiling: any wrapped (vertical shift, horizontal jitter) is a window
+    # noise_pad[off:off+h, c:c+w] with c = -jitter % w, i.e. np.roll folded into indexing
+    noise_pad = np.tile(noise != 0, (2, 2))
+    mask_pad = np.tile(mask.astype(bool), (1, 2))
+    rows = np.arange(h)
+    cols0 = (-jitter) % w
+    frames = np.empty((frames_n, h, (w + 7) // 8), dtype=np.uint8)
+    # Frames sharing a column window (at most 3) share packed operands: pack each window once,
+    # then the composite is a row gather plus the bitwise select fg & m | bg & ~m, 8 pixels a byte
+    for c in np.unique(cols0):
+        idx = np.flatnonzero(cols0 == c)
+        noise_bits = np.packbits(noise_pad[:, c:c + w], axis=1)
+        mask_bits = np.packbits(mask_pad[:, c:c + w], axis=1)
+        bg_bits = noise_bits[:h] & ~mask_bits
+        fg = noise_bits[offs[idx, None] + rows]
+        np.bitwise_and(fg, mask_bits, out=fg)
+        np.bitwise_or(fg, bg_bits, out=fg)
+        frames[idx] = fg
+    return frames
+
+def _build_frames(
+    noise: np.ndarray,
+    mask: np.ndarray,
+    frames_n: int,
+    speed_px_per_frame: int,
+    rng: np.random.RandomState,
+) -> np.ndarray:
+    """
+    Build the whole grayscale clip as one uint8 array [frames_n, h, w], values in {0, 255},
+    for encoders that need a byte per pixel.
+    """
+    h, w = noise.shape
+    if numba is not None:
+        if mask.shape != noise.shape:
+            # The kernel indexes mask with the frame's dimensions and numba does no bounds checks
+            raise ValueError(f"mask shape {mask.shape} does not match frame shape {noise.shape}")
+        offs, jitter = _frame_offsets(frames_n, h, speed_px_per_frame, rng)
+        frames = np.empty((frames_n, h, w), dtype=np.uint8)
+        with _NUMBA_LOCK:
+            _compose_frames_numba(noise, mask.astype(np.bool_), offs, jitter, frames)
+        return frames
+
+    # Compose packed, then expand each bit to a 0/255 byte in one contiguous block
+    frames = np.unpackbits(_build_frames_packed(noise, mask, frames_n, speed_px_per_frame, rng),
+                           axis=2, count=w)
+    np.multiply(frames, np.uint8(255), out=frames)
+    return frames
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _compose_frames_numba(noise, mask, offs, jitter, out):
+        """
+        Same result as the NumPy path of _build_frames in a single pass:
+        the vertical shift, mask select and horizontal jitter are fused per pixel.
+        """
+        frames_n, h, w = out.shape
+        for t in numba.prange(frames_n):
+            off = offs[t]
+            s = jitter[t]
+            for y in range(h):
+                sy = y + off
+                if sy >= h:
+                    sy -= h
+                fg = noise[sy]
+                bg = noise[y]
+                m = mask[y]
+                row = out[t, y]
+                if s == 0:
+                    for x in range(w):
+                        row[x] = fg[x] if m[x] else bg[x]
+                else:
+                    # np.roll(frame, s, axis=1) reads column x - s (wrapped)
+                    for x in range(w):
+                        sx = (x - s) % w
+                        row[x] = fg[sx] if m[sx] else bg[sx]
+
+def _ffmpeg_path() -> Optional[str]:
+    return shutil.which("ffmpeg")
+
+def _encode_ffmpeg(ffmpeg: str, frames: np.ndarray, w: int, h: int, fps: int, pix_fmt: str = "gray") -> bytes:
+    """
+    Encode raw frames to H.264 MP4 entirely through pipes (no temp file).
+    pix_fmt: "gray" for [frames_n, h, w] bytes, "monob" for _build_frames_packed output.
+    Output is fragmented MP4 since the muxer cannot seek back on stdout.
+    """
+    cmd = [
+        ffmpeg, "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{w}x{h}", "-r", str(fps), "-i", "-",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4", "pipe:1",
+    ]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # The clip is one contiguous block: hand it over in a single write; communicate()
+    # drains stdout/stderr while writing, so ffmpeg never blocks on a full pipe
+    try:
+        out, err = p.communicate(input=memoryview(np.ascontiguousarray(frames)).cast("B"),
+                                 timeout=FFMPEG_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.wait()
+        p.stdout.close()
+        p.stderr.close()
+        raise ValueError(f"ffmpeg timed out after {FFMPEG_TIMEOUT_SEC}s")
+
+    if p.returncode != 0:
+        raise ValueError(f"ffmpeg failed: {err.decode(errors='replace').strip()}")
+    return out
+
+def _encode_nvenc(ffmpeg: str, frames: Iterable[np.ndarray], w: int, h: int, fps: int) -> bytes:
+    """
+    Encode grayscale frames to H.264 on NVENC, then remux (no re-encode) to MP4 with ffmpeg.
+    NVENC takes NV12: the Y plane is the frame, the interleaved UV plane stays at neutral 128.
+    """
+    settings = {"codec": "h264", "preset": "P1", "s": f"{w}x{h}", "fps": str(fps)}
+    nv12 = np.empty((h * 3 // 2, w), dtype=np.uint8)
+    nv12[h:] = 128
+    packet = np.ndarray(shape=(0,), dtype=np.uint8)
+    bitstream = bytearray()
+    key = (w, h, fps)
+    with _NVENC_LOCK:
+        enc = _NVENC_ENCODERS.get(key)
+        try:
+            if enc is None:
+                enc = _NVENC_ENCODERS[key] = nvc.PyNvEncoder(settings, NVENC_GPU_ID)
+            else:
+                # Each clip must be a standalone stream: restart it on an IDR frame
+                enc.Reconfigure(settings, force_idr=True, reset_encoder=True)
+            for frame in frames:
+                nv12[:h] = frame
+                if enc.EncodeSingleFrame(nv12, packet):
+                    bitstream += packet.tobytes()
+            while enc.FlushSinglePacket(packet):
+                bitstream += packet.tobytes()
+        except Exception:
+            _NVENC_ENCODERS.pop(key, None)  # don't hand a session in unknown state to the next clip
+            raise
+
+    cmd = [
+        ffmpeg, "-loglevel", "error", "-y",
+        "-fflags", "+genpts", "-f", "h264", "-r", str(fps), "-i", "-",
+        "-c:v", "copy",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4", "pipe:1",
+    ]
+    try:
+        p = subprocess.run(cmd, input=bytes(bitstream), capture_output=True, timeout=FFMPEG_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        raise ValueError(f"ffmpeg remux timed out after {FFMPEG_TIMEOUT_SEC}s")
+    if p.returncode != 0:
+        raise ValueError(f"ffmpeg remux failed: {p.stderr.decode(errors='replace').strip()}")
+    return p.stdout
+
+def _encode_cv2(frames: Iterable[np.ndarray], w: int, h: int, fps: int) -> bytes:
+    """
+    Fallback when ffmpeg is unavailable: cv2.VideoWriter needs a path, so use a
+    temp file (on tmpfs when present) and read it back.
+    """
+    # Try different codecs for better browser compatibility
+    try:
+        fourcc = cv2.VideoWriter_fourcc(*"avc1")  # H.264, most compatible
+    except:
+        try:
+            fourcc = cv2.VideoWriter_fourcc(*"x264")  # Alternative H.264
+        except:
+            fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # Fallback to mp4v
+
+    tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, tmp_path = tempfile.mkstemp(prefix="captcha_", suffix=".mp4", dir=tmp_dir)
+    os.close(fd)
+    try:
+        # Single-channel writer: frames go in as-is instead of being tripled to BGR first
+        writer = cv2.VideoWriter(tmp_path, fourcc, fps, (w, h), isColor=False)
+        for frame in frames:
+            writer.write(frame)
+        writer.release()
+
+        with open(tmp_path, "rb") as f:
+            return f.read()
+    finally:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+
+def _build_mask(
+    mode: str,
+    answer: Optional[str],
+    depth_image: Optional[np.ndarray],
+    thresholds: Tuple[int, int],
+    w: int,
+    h: int,
+    rng: np.random.RandomState,
+) -> Tuple[np.ndarray, str]:
+    """
+    Pick the answer if not given and return (mask M(x,y) ∈ {0,1}, answer).
+    """
     if mode == "text":
         if not answer:
             # random simple word - shorter and clearer
-            answer = "".join(rng.choice(list(string.ascii_lowercase), size=rng.randint(3,5)))
+            # one vector draw of ASCII codes 'a'..'z'
+            n = rng.randint(3, 5)
+            answer = rng.randint(ord("a"), ord("z") + 1, size=n, dtype=np.uint8).tobytes().decode("ascii")
         # For text mode, use larger font for better visibility
         mask = _render_text_mask(w, h, answer, font_size_ratio=0.4)
     elif mode == "shape":
         shapes = ["circle", "rectangle", "triangle", "heart", "arrow"]
         if not answer:
             answer = rng.choice(shapes)
-        mask = _render_shape_mask(w, h, answer)
+        mask = _shape_mask_cached(str(answer), w, h)
     elif mode == "depth":
         if depth_image is None:
             raise ValueError("depth_image is required for depth mode")
         tl, tu = thresholds
+        if depth_image.shape[:2] != (h, w):
+            # The clip is always size; the upload's resolution must not set the encode cost
+            depth_image = cv2.resize(np.asarray(depth_image, dtype=np.uint8), (w, h),
+                                     interpolation=cv2.INTER_NEAREST)
         mask = _depth_mask_from_image(depth_image, tl, tu)
         if not answer:
             answer = "object"  # generic; server-side can map to concrete label per source
     else:
         raise ValueError("Unsupported mode")
+    return mask, answer
 
+def _render_video(
+    mask: np.ndarray,
+    size: Tuple[int, int],
+    fps: int,
+    frames_n: int,
+    speed_px_per_frame: int,
+    noise_block: int,
+    noise_density: float,
+    rng: np.random.RandomState,
+    backend: str = "auto",
+) -> bytes:
+    """
+    Render and encode one clip of the given size for a mask with a fresh noise pattern.
+    """
+    global _NVENC_DISABLED
+    w, h = size
+    if mask.shape != (h, w):
+        raise ValueError(f"mask shape {mask.shape} does not match size {size}")
     # Single noise pattern; background static, foreground moves (Algorithm 2 style)
     noise = _make_tiled_noise(h, w, block=noise_block, density=noise_density, seed=None)
 
-    # Compose frames
-    frames_rgb: List[np.ndarray] = []
-    for t in range(frames_n):
-        # Foreground: shifted noise; Background: static noise
-        shifted = _shift_vertical(noise, offset=speed_px_per_frame * t)
-        # Assemble by mask
-        fg = shifted
-        bg = noise
-        frame = (mask * fg + (1 - mask) * bg).astype(np.uint8)
-        # Optional slight horizontal jitter to make replay harder
-        if t % 7 == 0:
-            frame = np.roll(frame, shift=rng.randint(-1, 2), axis=1)
-
-        # Convert to RGB and apply mild contrast for visibility
-        rgb = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-        frames_rgb.append(rgb)
-
-    # Encode MP4 to memory (H.264 or MPEG-4)
-    # Note: cv2.VideoWriter needs a path; we write to temp in memory and read back.
-    tmp_path = f"/tmp/captcha_{rng.randint(1, 1_000_000)}.mp4"
-    # Try different codecs for better browser compatibility
-    try:
-        fourcc = cv2.VideoWriter_fourcc(*"avc1")  # H.264, most compatible
-    except:
+    # Encode MP4 to memory: NVENC when available, else pipe raw frames through ffmpeg
+    ffmpeg = _ffmpeg_path()
+    frames = None
+    mp4_bytes = b""
+    if (backend == "nvenc" or (backend == "auto" and not _NVENC_DISABLED)) and nvc is not None and ffmpeg:
+        frames = _build_frames(noise, mask, frames_n, speed_px_per_frame, rng)
         try:
-            fourcc = cv2.VideoWriter_fourcc(*"x264")  # Alternative H.264
-        except:
-            fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # Fallback to mp4v
-
-    writer = cv2.VideoWriter(tmp_path, fourcc, fps, (w, h))
-    for fr in frames_rgb:
-        writer.write(fr)
-    writer.release()
-
-    with open(tmp_path, "rb") as f:
-        mp4_bytes = f.read()
+            mp4_bytes = _encode_nvenc(ffmpeg, frames, w, h, fps)
+        except Exception as e:
+            if backend == "nvenc":
+                raise
+            _NVENC_DISABLED = True
+            print(f"NVENC encoding failed, using CPU encoding from now on: {e}")
+    if not mp4_bytes and ffmpeg:
+        try:
+            if frames is None:
+                # 1 bit per pixel from composition into ffmpeg: 8x fewer bytes built and piped
+                packed = _build_frames_packed(noise, mask, frames_n, speed_px_per_frame, rng)
+                mp4_bytes = _encode_ffmpeg(ffmpeg, packed, w, h, fps, pix_fmt="monob")
+            else:
+                mp4_bytes = _encode_ffmpeg(ffmpeg, frames, w, h, fps)
+        except (ValueError, OSError) as e:
+            # e.g. an ffmpeg build without libx264
+            print(f"ffmpeg encoding failed, falling back to cv2: {e}")
+    if not mp4_bytes:
+        if frames is None:
+            frames = _build_frames(noise, mask, frames_n, speed_px_per_frame, rng)
+        mp4_bytes = _encode_cv2(frames, w, h, fps)
 
     # Debug: Check if file was created successfully
     if len(mp4_bytes) == 0:
         raise ValueError("Failed to generate video file")
 
     print(f"Generated MP4 file size: {len(mp4_bytes)} bytes")
+    return mp4_bytes
 
-    try:
-        os.remove(tmp_path)
-    except Exception:
-        pass
+def generate_time_captcha(
+    mode: str = "text",                # 'text' | 'shape' | 'depth'
+    answer: Optional[str] = None,      # ground truth word/shape; required for text/shape
+    depth_image: Optional[np.ndarray] = None,  # uint8 grayscale for 'depth' mode
+    thresholds: Tuple[int, int] = (90, 180),
+    size: Tuple[int, int] = (DEFAULT_WIDTH, DEFAULT_HEIGHT),
+    fps: int = DEFAULT_FPS,
+    duration_sec: float = DEFAULT_DURATION_SEC,
+    speed_px_per_frame: int = DEFAULT_SPEED_PX_PER_FRAME,
+    noise_block: int = DEFAULT_NOISE_BLOCK,
+    noise_density: float = DEFAULT_NOISE_DENSITY,
+    seed: Optional[int] = None,
+    reuse_video: bool = False,         # shape only: serve one of VIDEO_POOL_SIZE cached renders
+    backend: str = "auto",             # 'auto' (NVENC if available) | 'nvenc' (required) | 'cpu'
+) -> Tuple[bytes, str]:
+    """
+    Generate MP4 bytes and ground-truth string.
+    With reuse_video (shape mode only), the clip comes from a per-answer pool of pre-encoded
+    renders; faster, but the finite set of clips per answer can be catalogued by an attacker.
+    Text and depth clips are always rendered fresh.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {BACKENDS}")
+    if backend == "nvenc" and (nvc is None or not _ffmpeg_path()):
+        raise ValueError("backend='nvenc' requires PyNvCodec and ffmpeg")
+    w, h = size
+    frames_n = int(fps * duration_sec)
+    rng = np.random.RandomState(seed)
+
+    mask, answer = _build_mask(mode, answer, depth_image, thresholds, w, h, rng)
+    render = (mask, size, fps, frames_n, speed_px_per_frame, noise_block, noise_density)
+    if not (reuse_video and mode == "shape"):
+        return _render_video(*render, rng, backend), answer
+
+    key = (mode, answer, w, h, fps, frames_n, speed_px_per_frame, noise_block, noise_density,
+           rng.randint(VIDEO_POOL_SIZE))
+    with _VIDEO_CACHE_LOCK:
+        mp4_bytes = _VIDEO_CACHE.get(key)
+        if mp4_bytes is not None:
+            _VIDEO_CACHE.move_to_end(key)
+            return mp4_bytes, answer
 
+    mp4_bytes = _render_video(*render, rng, backend)
+    with _VIDEO_CACHE_LOCK:
+        _VIDEO_CACHE[key] = mp4_bytes
+        while len(_VIDEO_CACHE) > VIDEO_CACHE_SIZE:
+            _VIDEO_CACHE.popitem(last=False)
     return mp4_bytes, answer
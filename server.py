@@ -1,19 +1,27 @@
 # filename: server.py
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
+import os
 import time
 import secrets
-from typing import Dict, Optional
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from pydantic import BaseModel
 
 from captcha_generator import generate_time_captcha
 
 """
 FastAPI service for time-encoded CAPTCHA
-- POST /captcha/new: create a new CAPTCHA, returns id + video (Base64) + hint
+- POST /captcha/new: create a new CAPTCHA, returns id + video URL + hint
+- GET /captcha/video/{id}: raw MP4 bytes for that CAPTCHA
 - POST /captcha/verify: submit id + answer, returns success
 - In-memory store with TTL; production should use Redis and CDN for video delivery
 
@@ -25,15 +33,105 @@ Security best practices:
 - Server-side validation
 """
 
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    yield
+    # GEN_POOL is looked up at shutdown: it may have been replaced after a worker died
+    GEN_POOL.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=_lifespan)
 
 # Serve the demo HTML at root
 @app.get("/")
 async def serve_demo():
     return FileResponse("static_demo.html")
 
-CAPTCHA_STORE: Dict[str, Dict] = {}
+# Insertion order == expiry order (fixed TTL), so expired records sit at the front
+CAPTCHA_STORE: "OrderedDict[str, Dict]" = OrderedDict()
 TTL_SECONDS = 180  # 3 minutes
+# Serve shape videos from a per-answer pool of cached renders; see generate_time_captcha
+# for the trade-off. Passed to _generate per call: pool workers don't see later edits.
+REUSE_VIDEOS = False
+
+# MP4s live in their own store: the player fetches them right after /captcha/new, so
+# they get a much shorter TTL than the answer plus a total size cap (oldest dropped first)
+VIDEO_STORE: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
+VIDEO_TTL_SECONDS = 60
+VIDEO_STORE_MAX_BYTES = 256 * 1024 * 1024
+_video_store_bytes = 0
+
+# Every CAPTCHA_STORE/VIDEO_STORE insert/pop takes this lock: /captcha/new mutates it from the
+# event loop while the sync endpoints run on the threadpool
+_STORE_LOCK = threading.Lock()
+
+def _video_pop(cid: str) -> None:
+    global _video_store_bytes
+    entry = VIDEO_STORE.pop(cid, None)
+    if entry is not None:
+        _video_store_bytes -= len(entry[1])
+
+def _store_pop(cid: str) -> None:
+    with _STORE_LOCK:
+        CAPTCHA_STORE.pop(cid, None)
+        _video_pop(cid)
+
+def _store_put(cid: str, rec: Dict, mp4: bytes) -> None:
+    global _video_store_bytes
+    with _STORE_LOCK:
+        CAPTCHA_STORE[cid] = rec
+        VIDEO_STORE[cid] = (rec["created_at"] + VIDEO_TTL_SECONDS, mp4)
+        _video_store_bytes += len(mp4)
+        while _video_store_bytes > VIDEO_STORE_MAX_BYTES and len(VIDEO_STORE) > 1:
+            _video_pop(next(iter(VIDEO_STORE)))
+
+def _evict_expired(now: int) -> None:
+    """Drop expired records from the front of the stores; stops at the first live one."""
+    with _STORE_LOCK:
+        while CAPTCHA_STORE:
+            cid, oldest = next(iter(CAPTCHA_STORE.items()))
+            if now <= oldest["expires_at"]:
+                break
+            CAPTCHA_STORE.pop(cid, None)
+        while VIDEO_STORE:
+            cid, (expires_at, _) = next(iter(VIDEO_STORE.items()))
+            if now <= expires_at:
+                break
+            _video_pop(cid)
+
+# CPU-bound generation runs in worker processes: no GIL contention with the
+# endpoints and the event loop never waits on NumPy/Pillow/encoder work
+def _init_gen_worker():
+    # The pool already uses every core: a parallel numba kernel per worker would
+    # start cpu_count() threads in each of cpu_count() processes
+    try:
+        import numba
+        numba.set_num_threads(1)
+    except ImportError:
+        pass
+
+def _make_gen_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_gen_worker)
+
+GEN_POOL = _make_gen_pool()
+# Generations queued or running; past this /captcha/new answers 503 instead of
+# letting the pool's queue (and client latency) grow without bound
+GEN_MAX_PENDING = 4 * (os.cpu_count() or 1)
+_gen_pending = 0
+
+async def _run_generate(*args) -> Tuple[bytes, str]:
+    """Run _generate in GEN_POOL, replacing the pool once if a worker died (OOM kill, segfault)."""
+    global GEN_POOL
+    loop = asyncio.get_running_loop()
+    pool = GEN_POOL
+    try:
+        return await loop.run_in_executor(pool, _generate, *args)
+    except BrokenProcessPool:
+        # A broken executor rejects every later submit; only the first caller swaps it
+        if GEN_POOL is pool:
+            print("Generation pool broken, restarting it")
+            GEN_POOL = _make_gen_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return await loop.run_in_executor(GEN_POOL, _generate, *args)
 
 class NewCaptchaRequest(BaseModel):
     mode: str = "text"          # "text" | "shape" | "depth" | "random"
@@ -44,7 +142,7 @@ class NewCaptchaRequest(BaseModel):
 
 class NewCaptchaResponse(BaseModel):
     id: str
-    video_base64: str
+    video_url: str  # GET it for the raw MP4; no Base64 inflation in the JSON
     hint: str  # e.g., "请识别视频中的单词" / "请识别形状"
     expires_at: int
 
@@ -56,8 +154,34 @@ class VerifyResponse(BaseModel):
     success: bool
     message: str
 
+def _generate(mode: str, depth_image: Optional[str] = None,
+              thresholds: Tuple[int, int] = (90, 180),
+              reuse_video: bool = False) -> Tuple[bytes, str]:
+    """
+    Worker-side entry point (module level so it pickles): decode the optional
+    depth image and render the video.
+    """
+    if mode == "depth" and depth_image:
+        # For depth mode with custom depth image
+        from io import BytesIO
+        from PIL import Image
+        import numpy as np
+
+        # Decode base64 depth image
+        image_data = base64.b64decode(depth_image.split(',')[1])
+        depth_img = Image.open(BytesIO(image_data)).convert('L')
+        depth_array = np.array(depth_img)
+
+        return generate_time_captcha(
+            mode=mode,
+            depth_image=depth_array,
+            thresholds=thresholds
+        )
+    # Standard generation for text/shape modes
+    return generate_time_captcha(mode=mode, reuse_video=reuse_video)
+
 @app.post("/captcha/new", response_model=NewCaptchaResponse)
-def new_captcha(req: NewCaptchaRequest):
+async def new_captcha(req: NewCaptchaRequest):
     # Handle random mode selection
     import random
     if req.mode == "random":
@@ -65,39 +189,27 @@ def new_captcha(req: NewCaptchaRequest):
     else:
         mode = req.mode
 
-    # Generate CAPTCHA with enhanced parameters
+    # Only touched from the event loop, so the check-and-increment needs no lock
+    global _gen_pending
+    if _gen_pending >= GEN_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试",
+                            headers={"Retry-After": "1"})
+    _gen_pending += 1
     try:
-        if mode == "depth" and req.depth_image:
-            # For depth mode with custom depth image
-            from io import BytesIO
-            from PIL import Image
-            import numpy as np
-
-            # Decode base64 depth image
-            image_data = base64.b64decode(req.depth_image.split(',')[1])
-            depth_img = Image.open(BytesIO(image_data)).convert('L')
-            depth_array = np.array(depth_img)
-
+        # Generate CAPTCHA with enhanced parameters
+        try:
             # Convert threshold values (0-1) to pixel values (0-255)
             tl = int((req.threshold_low or 0.2) * 255)
             tu = int((req.threshold_high or 0.8) * 255)
+            mp4_bytes, answer = await _run_generate(mode, req.depth_image, (tl, tu), REUSE_VIDEOS)
+        except Exception as e:
+            # Fallback to text mode if generation fails
+            print(f"Failed to generate {mode} captcha: {e}")
+            mode = "text"
+            mp4_bytes, answer = await _run_generate(mode, None, (90, 180), REUSE_VIDEOS)
+    finally:
+        _gen_pending -= 1
 
-            mp4_bytes, answer = generate_time_captcha(
-                mode=mode,
-                depth_image=depth_array,
-                thresholds=(tl, tu)
-            )
-        else:
-            # Standard generation for text/shape modes
-            mp4_bytes, answer = generate_time_captcha(mode=mode)
-    except Exception as e:
-        # Fallback to text mode if generation fails
-        print(f"Failed to generate {mode} captcha: {e}")
-        mode = "text"
-        mp4_bytes, answer = generate_time_captcha(mode=mode)
-
-    # Base64-encode video for simple delivery; consider CDN in prod
-    b64 = base64.b64encode(mp4_bytes).decode("ascii")
     hint = {
         "text": "请识别视频中的单词（播放过程中才能看清）",
         "shape": "请识别视频中的形状（播放过程中才能看清）",
@@ -107,7 +219,8 @@ def new_captcha(req: NewCaptchaRequest):
     # Store with TTL
     cid = secrets.token_urlsafe(18)
     now = int(time.time())
-    CAPTCHA_STORE[cid] = {
+    _evict_expired(now)
+    rec = {
         "answer": answer.lower(),
         "created_at": now,
         "expires_at": now + TTL_SECONDS,
@@ -116,28 +229,74 @@ def new_captcha(req: NewCaptchaRequest):
         "difficulty": req.difficulty,
         "hint": hint,
     }
+    _store_put(cid, rec, mp4_bytes)
 
     return NewCaptchaResponse(
         id=cid,
-        video_base64=b64,
+        video_url=f"/captcha/video/{cid}",
         hint=hint,
         expires_at=now + TTL_SECONDS,
     )
 
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range 'bytes=a-b' / 'bytes=a-' / 'bytes=-n' header into inclusive (start, end).
+
+    Returns None for anything we don't serve partially (multi-range, other units) and,
+    per RFC 9110, for invalid ranges such as 'bytes=5-3', which get the full body;
+    raises 416 for a well-formed but unsatisfiable range.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = (part.strip() for part in spec.partition("-"))
+    if not sep or not (first or last) or not all(p.isdecimal() for p in (first, last) if p):
+        return None
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+@app.get("/captcha/video/{captcha_id}")
+def get_video(captcha_id: str, request: Request):
+    now = int(time.time())
+    _evict_expired(now)
+    entry = VIDEO_STORE.get(captcha_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="验证码不存在或已过期")
+
+    # Kept until verify/expiry: looping <video> elements may fetch more than once,
+    # and Safari/iOS only play MP4 served with byte-range support
+    data = entry[1]
+    headers = {"Cache-Control": "no-store", "Accept-Ranges": "bytes"}
+    rng = request.headers.get("range")
+    byte_range = _parse_range(rng, len(data)) if rng else None
+    if byte_range is None:
+        return Response(data, media_type="video/mp4", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(data[start:end + 1], status_code=206, media_type="video/mp4", headers=headers)
+
 @app.post("/captcha/verify", response_model=VerifyResponse)
 def verify(req: VerifyRequest):
+    now = int(time.time())
+    _evict_expired(now)
     rec = CAPTCHA_STORE.get(req.id)
     if not rec:
         return VerifyResponse(success=False, message="验证码不存在或已过期")
 
-    now = int(time.time())
     if now > rec["expires_at"]:
-        CAPTCHA_STORE.pop(req.id, None)
+        _store_pop(req.id)
         return VerifyResponse(success=False, message="验证码已过期")
 
     rec["attempts"] += 1
     if rec["attempts"] > 5:
-        CAPTCHA_STORE.pop(req.id, None)
+        _store_pop(req.id)
         return VerifyResponse(success=False, message="尝试次数过多，已失效")
 
     user_ans = req.answer.strip().lower()
@@ -167,26 +326,27 @@ def verify(req: VerifyRequest):
         ok = (user_ans == truth)
 
     if ok:
-        CAPTCHA_STORE.pop(req.id, None)
+        _store_pop(req.id)
         return VerifyResponse(success=True, message="验证成功")
     else:
         return VerifyResponse(success=False, message="答案不正确")
 
 @app.get("/captcha/hint/{captcha_id}")
 def get_hint(captcha_id: str):
+    now = int(time.time())
+    _evict_expired(now)
     rec = CAPTCHA_STORE.get(captcha_id)
     if not rec:
         raise HTTPException(status_code=404, detail="验证码不存在或已过期")
 
-    now = int(time.time())
     if now > rec["expires_at"]:
-        CAPTCHA_STORE.pop(captcha_id, None)
+        _store_pop(captcha_id)
         raise HTTPException(status_code=404, detail="验证码已过期")
 
     # Return hint with penalty (increase attempts)
     rec["attempts"] += 1
     if rec["attempts"] > 5:
-        CAPTCHA_STORE.pop(captcha_id, None)
+        _store_pop(captcha_id)
         raise HTTPException(status_code=410, detail="尝试次数过多，已失效")
 
     return {"hint": rec["hint"], "attempts": rec["attempts"]}